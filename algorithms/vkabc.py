@@ -1,7 +1,13 @@
 import math
+import threading
+import time
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from multiprocessing import Pool, cpu_count
 
+rng = np.random.default_rng()
+
 processes = cpu_count()
 print(f"using {processes} processes")
 
@@ -17,6 +23,50 @@ def _g(x, y):
     """
     return np.exp(-(np.dot(y - x, y - x)) / 5000)
 
+def _gram(x, y):
+    """Calculates the Gaussian kernel between all rows of two sample matrices.
+
+    Args:
+        x: First samples as a numpy array with one sample per row.
+        y: Second samples as a numpy array with one sample per row.
+
+    Returns:
+        Numpy array with the kernel value of row i of x and row j of y at position i, j.
+    """
+    squared_distances = np.sum(x * x, axis=1)[:, None] + np.sum(y * y, axis=1)[None, :] - 2 * np.dot(x, y.T)
+    return np.exp(-np.maximum(squared_distances, 0) / 5000)
+
+def _gram_sum(x, y, chunk=1024):
+    """Calculates the sum of the Gaussian kernel over all pairs of rows of two sample matrices in chunks of rows.
+
+    Args:
+        x: First samples as a numpy array with one sample per row.
+        y: Second samples as a numpy array with one sample per row.
+        chunk (int, optional): Number of rows of x per chunk. Defaults to 1024.
+
+    Returns:
+        number: The sum.
+    """
+    if len(x) == 0 or len(y) == 0:
+        return 0.0
+    return sum(float(np.sum(_gram(x[c:c + chunk], y))) for c in range(0, len(x), chunk))
+
+def _map(function, tasks, pool=None):
+    """Applies a function to every task in parallel.
+
+    Args:
+        function: The function to apply.
+        tasks (list): The tasks.
+        pool (optional): Process pool to use. Defaults to None, which uses a new one.
+
+    Returns:
+        list: The results in the order of the tasks.
+    """
+    if pool is not None:
+        return pool.map(function, tasks)
+    with Pool(processes=processes) as pool:
+        return pool.map(function, tasks)
+
 def _sample(n, arms):
     """Samples every arm n times and returns a list of numpy arrays.
 
@@ -76,26 +126,29 @@ def _calculate_single_distance(args):
     return i, j, math.sqrt(d_squared)
 
 # Author: Claude code
-def _calculate_distances(data):
+def _calculate_distances(data, pairs=None, pool=None):
     """Calculates the pairwise distance between all arms.
 
     Args:
         data: List of samples for every arm.
+        pairs (list, optional): Pairs (i, j) with i > j to calculate the distance for. Defaults to all pairs.
+        pool (optional): Process pool to use. Defaults to None, which uses a new one.
 
     Returns:
-        Numpy array containing the empirical distances of all pairs of arms in a matrix.
+        Numpy array containing the empirical distances of all pairs of arms in a matrix. Pairs that were not
+        calculated are zero.
     """
     distances = np.zeros((len(data), len(data)))
+    if pairs is None:
+        pairs = [(i, j) for i in range(len(data)) for j in range(i)]
     
     # Prepare arguments for parallel processing
     args_list = []
-    for i in range(len(data)):
-        for j in range(i):
-            args_list.append((i, j, data[i], data[j]))
+    for i, j in pairs:
+        args_list.append((i, j, data[i], data[j]))
     
     # Calculate distances in parallel
-    with Pool(processes=processes) as pool:
-        results = pool.map(_calculate_single_distance, args_list)
+    results = _map(_calculate_single_distance, args_list, pool)
     
     # Fill the distance matrix
     for i, j, distance in results:
@@ -104,12 +157,25 @@ def _calculate_distances(data):
     
     return distances
 
+def _calculate_variances(data, pool=None):
+    """Calculates the empirical variance of every arm in parallel.
+
+    Args:
+        data: List of samples for every arm.
+        pool (optional): Process pool to use. Defaults to None, which uses a new one.
+
+    Returns:
+        List of variances for every arm.
+    """
+    return _map(_calculate_single_arm_variance, data, pool)
+
 # Author: Claude code
-def _calculate_variances_and_distances(data):
+def _calculate_variances_and_distances(data, pool=None):
     """Calculate both variances and distances in parallel using a single process pool.
 
     Args:
         data: List of samples for every arm.
+        pool (optional): Process pool to use. Defaults to None, which uses a new one.
 
     Returns:
         List of variances for every arm, numpy array containing the empirical distances of all pairs of arms in a
@@ -130,8 +196,7 @@ def _calculate_variances_and_distances(data):
             all_tasks.append(('distance', (i, j), (data[i], data[j])))
     
     # Process all tasks in parallel
-    with Pool(processes=processes) as pool:
-        results = pool.map(_process_mixed_task, all_tasks)
+    results = _map(_process_mixed_task, all_tasks, pool)
     
     # Separate results
     variances = [None] * n_arms
@@ -170,42 +235,171 @@ def _process_mixed_task(task):
         distance = math.sqrt(d_squared)
         return ('distance', (i, j), distance)
 
-def _get_connected_components(adjacency):
-    """Get connected components of a graph represented by an adjacency matrix.
+def _select_landmarks(data, count, subsample=16):
+    """Selects well spread landmarks from the pooled samples of all arms by farthest point traversal.
+
+    Args:
+        data: List of samples for every arm.
+        count (int): Maximum number of landmarks.
+        subsample (int, optional): The traversal runs on at most subsample * count randomly chosen pooled samples.
+        Defaults to 16.
+
+    Returns:
+        Numpy array with one landmark per row.
+    """
+    points = np.concatenate(data)
+    if len(points) > subsample * count:
+        points = points[rng.choice(len(points), size=subsample * count, replace=False)]
+    if len(points) <= count:
+        return points
+    chosen = [0]
+    closest = np.sum((points - points[0]) ** 2, axis=1)
+    while len(chosen) < count:
+        next_landmark = int(np.argmax(closest))
+        chosen.append(next_landmark)
+        closest = np.minimum(closest, np.sum((points - points[next_landmark]) ** 2, axis=1))
+    return points[chosen]
+
+def _calculate_distance_lower_bounds(data, landmarks):
+    """Calculates certified lower bounds on the empirical distances of all pairs of arms from cheap summaries.
+
+    The kernel mean embedding of every arm is evaluated at a few landmarks, which are chosen among the pooled samples
+    of all arms. The norm of the projection of the difference of two embeddings onto the span of the landmark
+    features can never exceed the empirical distance, so it is a lower bound. Costs O(N * n * landmarks) instead of
+    O(N^2 * n^2).
+
+    Args:
+        data: List of samples for every arm.
+        landmarks (int): Maximum number of landmarks.
+
+    Returns:
+        Numpy array containing lower bounds of the empirical distances of all pairs of arms in a matrix.
+    """
+    z = _select_landmarks(data, landmarks)
+    embeddings = np.array([np.mean(_gram(arm_data, z), axis=0) for arm_data in data])
+
+    # Regularizing the landmark Gram matrix only makes the bound smaller, so it stays valid
+    cholesky = np.linalg.cholesky(_gram(z, z) + 1e-6 * np.eye(len(z)))
+    features = np.linalg.solve(cholesky, embeddings.T).T
+
+    squared_norms = np.sum(features * features, axis=1)
+    squared_bounds = squared_norms[:, None] + squared_norms[None, :] - 2 * np.dot(features, features.T)
+    return np.sqrt(np.maximum(squared_bounds, 0))
+
+def _prefiltered_distances(arms, bounds, lower_bounds, distances, tau=True):
+    """Calculates the empirical distances of the pairs of arms that are not pruned by their lower bounds.
+
+    A pair is pruned if its lower bound already exceeds its bound. The estimate of the theoretical sampling complexity
+    only needs the smallest distance between arms from different clusters, so pruned pairs from different clusters
+    are calculated as well until none of the remaining ones has a lower bound below the smallest calculated distance.
+
+    Args:
+        arms: Multi-armed bandit.
+        bounds: Pairwise bounds of the arms.
+        lower_bounds: Pairwise lower bounds on the distances of the arms.
+        distances: Function returning a numpy array containing the empirical distances of the pairs of arms that are
+        marked in a boolean numpy array in a matrix.
+        tau (bool, optional): Whether the pruned pairs needed for the estimate of the theoretical sampling complexity
+        are calculated as well. Defaults to True.
+
+    Returns:
+        Numpy array containing the empirical distances of all pairs of arms in a matrix, with infinity for pairs that
+        were not calculated, boolean numpy array marking the pairs i > j that were not pruned.
+    """
+    N = len(arms)
+    # The tolerance guards against rounding errors in the lower bounds
+    candidates = np.tril(lower_bounds <= bounds + 1e-9, -1)
+    clusters = np.array([arm.cluster for arm in arms])
+    different_clusters = np.tril(clusters[:, None] != clusters[None, :], -1)
+
+    dists = np.full((N, N), np.inf)
+    calculated = np.zeros((N, N), dtype=bool)
+    pairs = candidates
+    while True:
+        if np.any(pairs):
+            dists[pairs] = distances(pairs)[pairs]
+            calculated |= pairs
+        Delta_min = np.min(dists[different_clusters], initial=np.inf)
+        pairs = different_clusters & ~calculated & (lower_bounds < Delta_min)
+        if not tau or not np.any(pairs):
+            break
+        if np.isinf(Delta_min):
+            # Without any calculated pair from different clusters, start with the smallest lower bound
+            first = np.argmin(np.where(pairs, lower_bounds, np.inf))
+            pairs = np.zeros((N, N), dtype=bool)
+            pairs.flat[first] = True
+
+    pruned = (N * N - N) // 2 - np.count_nonzero(candidates)
+    print(f"pruned {pruned} of {(N * N - N) // 2} pairs, calculated {np.count_nonzero(calculated & ~candidates)} "
+          f"of them for tau")
+    dists = np.minimum(dists, dists.T)
+    np.fill_diagonal(dists, 0)
+    return dists, candidates
+
+def _get_connected_components(N, rows, cols):
+    """Get connected components of a graph represented by an edge list.
+
+    The components and the order of the nodes in them are the ones of a depth-first search that starts at the
+    smallest unvisited node and visits neighbors in ascending order.
 
     Args:
-        adjacency: Graph as an adjacency matrix.
+        N: Number of nodes.
+        rows: Numpy array with the first node of every edge.
+        cols: Numpy array with the second node of every edge.
 
     Returns:
         Connected components as a list of lists.
     """
-    # https://www.geeksforgeeks.org/dsa/connected-components-in-an-undirected-graph/
-    n = len(adjacency)
+    # Label propagation with pointer jumping until every node is labeled with the smallest node of its component
+    labels = np.arange(N)
+    while True:
+        propagated = labels.copy()
+        np.minimum.at(propagated, rows, labels[cols])
+        np.minimum.at(propagated, cols, labels[rows])
+        propagated = propagated[propagated]
+        if np.array_equal(propagated, labels):
+            break
+        labels = propagated
 
-    def dfs(node, adj_list, visited, component):
-        visited[node] = True
-        component.append(node)
-        for neighbor in adj_list[node]:
-            if not visited[neighbor]:
-                dfs(neighbor, adj_list, visited, component)
+    # Components ordered by their smallest node, with their nodes in ascending order
+    nodes = np.argsort(labels, kind='stable')
+    sizes = np.bincount(labels, minlength=N)
+    edges = np.bincount(labels[rows], minlength=N)
+    roots = np.flatnonzero(sizes)
+    components = np.split(nodes, np.cumsum(sizes[roots])[:-1])
 
-    adj_list = [[] for _ in range(n)]
-    for i in range(n):
-        m = len(adjacency[i])
-        assert n == m
-        for j in range(i):
-            if adjacency[i][j]:
-                adj_list[i].append(j)
-                adj_list[j].append(i)
+    # Sorted neighbor lists of the undirected graph in compressed sparse row format
+    sources = np.concatenate((rows, cols))
+    targets = np.concatenate((cols, rows))
+    neighbors = targets[np.lexsort((targets, sources))]
+    offsets = np.concatenate(([0], np.cumsum(np.bincount(sources, minlength=N))))
+    pointers = offsets[:-1].copy()
+    visited = np.zeros(N, dtype=bool)
 
-    visited = [False for _ in range(n)]
     res = []
-
-    for i in range(n):
-        if not visited[i]:
-            component = []
-            dfs(i, adj_list, visited, component)
-            res.append(component)
+    for root, component in zip(roots, components):
+        size = sizes[root]
+        # The depth-first search walks a complete component in ascending order
+        if 2 * edges[root] == size * (size - 1):
+            res.append(component.tolist())
+            continue
+        # Otherwise search it, advancing a pointer into the neighbors of every node instead of stacking all of them
+        component = [int(root)]
+        visited[root] = True
+        stack = [int(root)]
+        while stack:
+            node = stack[-1]
+            unvisited = np.flatnonzero(~visited[neighbors[pointers[node]:offsets[node + 1]]])
+            if len(unvisited) == 0:
+                stack.pop()
+                continue
+            position = pointers[node] + unvisited[0]
+            pointers[node] = position + 1
+            neighbor = int(neighbors[position])
+            visited[neighbor] = True
+            component.append(neighbor)
+            stack.append(neighbor)
+        res.append(component)
 
     return res
 
@@ -224,13 +418,9 @@ def _calculate_tau(arms, delta, vars, dists):
     """
     N = len(arms)
     log_term = math.log((32 * (N*N - N))/delta)
-    distances_different_clusters = []
-    for (i, arm_i) in enumerate(arms):
-        for (j, arm_j) in enumerate(arms):
-            if not arm_i.cluster == arm_j.cluster:
-                d = dists[i][j]
-                distances_different_clusters.append(d)
-    Delta_min = min(distances_different_clusters)
+    clusters = np.array([arm.cluster for arm in arms])
+    different_clusters = clusters[:, None] != clusters[None, :]
+    Delta_min = np.min(np.asarray(dists)[different_clusters])
     V_max = max(vars)
     frac_1 = (128 * V_max) / (Delta_min * Delta_min)
     frac_2 = (112 + 16) / (3 * Delta_min)
@@ -238,83 +428,623 @@ def _calculate_tau(arms, delta, vars, dists):
     ceil_term = math.ceil(math.log2(max_term))
     return 8 * N * ((2 * math.log(ceil_term)) + log_term) * max_term
 
-def _VKABC_CLUSTER(k, delta, arms):
-    """The clustering procedure used in the adaptive VKABC algorithm
+def _vkabc_sample_size(k, delta, N):
+    """Calculates the number of samples per arm that VKABC draws in an iteration.
 
     Args:
         k: Iteration.
         delta: Confidence setting.
-        arms: Multi-armed bandit.
+        N: Number of arms.
 
     Returns:
-        List of lists as the clustering, the number of samples drawn, the estimate of the theoretical sampling
-        complexity.
+        int: Number of samples per arm.
     """
-    N = len(arms)
-    # First, we need to calculate the sample size
     log_term = 2 * math.log(k) + math.log((32 * (N*N - N))/delta)
-    nk = math.ceil(2**k * log_term)
-    delta_k = delta / (4 * (k * k))
-    data = _sample(nk, arms)
-    varis, dists = _calculate_variances_and_distances(data)
-    tau = _calculate_tau(arms, delta, varis, dists)
-    incidence = np.zeros((N, N))
+    return math.ceil(2**k * log_term)
 
-    # print(f"sampling {nk} values")
+def _kabc_sample_size(k, delta, N):
+    """Calculates the number of samples per arm that KABC draws in an iteration.
+
+    Args:
+        k: Iteration.
+        delta: Confidence setting.
+        N: Number of arms.
+
+    Returns:
+        int: Number of samples per arm.
+    """
+    log_term = 2 * math.log(k) + math.log((8 * (N*N - N))/delta)
+    return math.ceil(2**k * log_term)
+
+def _vkabc_bounds(k, delta, nk, varis):
+    """Calculates the bound on the distance of every pair of arms below which VKABC puts them in the same cluster.
+
+    Args:
+        k: Iteration.
+        delta: Confidence setting.
+        nk: Number of samples per arm.
+        varis (list): Variances of the arms.
+
+    Returns:
+        Numpy array containing the bounds of all pairs of arms in a matrix.
+    """
+    N = len(varis)
+    delta_k = delta / (4 * (k * k))
 
     psi_tilde = 1
 
     bound_log = math.log((8 * (N * N - N)) / delta_k) / nk
     bound_constant_part = (32/3) * math.sqrt(psi_tilde) * bound_log
 
-    print(f"sampled {nk} times per arm")
+    roots = np.sqrt(varis)
+    bounds = bound_constant_part + ((roots[:, None] + roots[None, :]) * (math.sqrt(2 * bound_log)))
+    np.fill_diagonal(bounds, 0)
+    return bounds
+
+def _kabc_bounds(k, delta, N, nk):
+    """Calculates the bound on the distance of every pair of arms below which KABC puts them in the same cluster.
+
+    Args:
+        k: Iteration.
+        delta: Confidence setting.
+        N: Number of arms.
+        nk: Number of samples per arm.
+
+    Returns:
+        Numpy array containing the bounds of all pairs of arms in a matrix.
+    """
+    delta_k = delta / (4 * (k * k))
+
+    g_bar = 1
+
+    bound = (2 * math.sqrt(g_bar/nk)) + (2 * math.sqrt((2 * g_bar * math.log((2 * (N*N - N))/delta_k))/nk))
+    return np.full((N, N), bound)
+
+def _permutation_rank(k, delta, N, permutations):
+    """Calculates the rank of the bound among the permuted distances at the level of a pair in an iteration.
+
+    Args:
+        k: Iteration.
+        delta: Confidence setting.
+        N: Number of arms.
+        permutations (int): Number of permutations per pair.
+
+    Returns:
+        int: The rank or None if the level can not be reached with the number of permutations.
+    """
+    delta_k = delta / (4 * (k * k))
+    alpha = delta_k / (N * N - N)
+    rank = math.ceil((1 - alpha) * (permutations + 1))
+    return rank if rank <= permutations else None
+
+def calibrated_iterations(delta, N, permutations):
+    """Calculates the last iteration whose bounds can be calibrated with a number of permutations.
+
+    Args:
+        delta: Confidence setting.
+        N: Number of arms.
+        permutations (int): Number of permutations per pair.
+
+    Returns:
+        int: The last calibrated iteration, 1 if no iteration is calibrated.
+    """
+    k = 1
+    while _permutation_rank(k + 1, delta, N, permutations) is not None:
+        k += 1
+    return k
+
+def final_iteration(algorithm, delta, N, sampling_complexity):
+    """Calculates the iteration in which an adaptive run stopped from its sampling complexity.
+
+    Args:
+        algorithm (str): 'VKABC' or 'KABC'.
+        delta: Confidence setting.
+        N: Number of arms.
+        sampling_complexity: The sampling complexity of the run.
+
+    Returns:
+        int: The iteration.
+    """
+    SAMPLE_SIZE = {'VKABC': _vkabc_sample_size, 'KABC': _kabc_sample_size}[algorithm]
+    k = 2
+    samples = N * SAMPLE_SIZE(k, delta, N)
+    while samples < sampling_complexity:
+        k += 1
+        samples += N * SAMPLE_SIZE(k, delta, N)
+    return k
+
+def _permutation_statistics(k, delta, N, n, gram, permutations, batch=64):
+    """Calculates the variances and distances of all arms and calibrates their bounds with a permutation test.
+
+    The samples of both arms of a pair are pooled and randomly split into two halves many times. The bound is the
+    quantile of the distances between the halves at the level of the pair, so arms from the same distribution stay
+    within it with the same confidence as with the analytic bounds. All permutations of a batch are evaluated together
+    as quadratic forms of the pooled Gram matrix of the pair, which also gives the distance of the pair and, through
+    its diagonal blocks, the variances.
+
+    Args:
+        k: Iteration.
+        delta: Confidence setting.
+        N: Number of arms.
+        n: Number of samples per arm.
+        gram: Function returning the Gram matrix of the samples of arm i and arm j for i >= j.
+        permutations (int): Number of permutations per pair.
+        batch (int, optional): Number of permutations evaluated together. Defaults to 64.
+
+    Returns:
+        List of variances for every arm, numpy array containing the empirical distances of all pairs of arms in a
+        matrix, numpy array containing the bounds of all pairs of arms in a matrix. None if the level of a pair can
+        not be reached with the number of permutations, before any Gram matrix is calculated.
+    """
+    rank = _permutation_rank(k, delta, N, permutations)
+    if rank is None:
+        print(f"{permutations} permutations can not reach the level of iteration {k}, using the analytic bounds")
+        return None
+
+    grams = [gram(i, i) for i in range(N)]
+    # The kernel of a sample with itself is 1
+    variances = [(n - np.sum(g) / n) / (n - 1) for g in grams]
+    signs = np.concatenate((np.full(n, 1 / n), np.full(n, -1 / n)))
+
+    distances = np.zeros((N, N))
+    bounds = np.zeros((N, N))
     for i in range(N):
         for j in range(i):
-            bound = bound_constant_part + ((math.sqrt(varis[i]) + math.sqrt(varis[j])) * (math.sqrt(2 * bound_log)))
+            cross = gram(i, j)
+            pooled = np.block([[grams[i], cross], [cross.T, grams[j]]])
+            d = math.sqrt(max(np.dot(signs, np.dot(pooled, signs)), 0))
+            distances[i][j] = d
+            distances[j][i] = d
+            d_squared = []
+            for start in range(0, permutations, batch):
+                s = rng.permuted(np.tile(signs, (min(batch, permutations - start), 1)), axis=1)
+                d_squared.append(np.sum(np.dot(s, pooled) * s, axis=1))
+            permuted = np.sqrt(np.maximum(np.concatenate(d_squared), 0))
+            bound = np.partition(permuted, rank - 1)[rank - 1]
+            bounds[i][j] = bound
+            bounds[j][i] = bound
+    return variances, distances, bounds
+
+def _cluster(dists, bounds, candidates=None):
+    """Clusters the arms by connecting every pair of arms whose distance is within its bound.
+
+    Args:
+        dists: Pairwise distances of the arms.
+        bounds: Pairwise bounds of the arms.
+        candidates (optional): Boolean numpy array marking the pairs that can be connected. Defaults to all pairs.
+
+    Returns:
+        Connected components as a list of lists.
+    """
+    N = len(dists)
+    connected = np.tril(np.asarray(dists) <= bounds, -1)
+    if candidates is not None:
+        connected &= candidates
+    rows, cols = np.nonzero(connected)
+    print(f"connected {len(rows)} of {(N * N - N) // 2} pairs")
+    return _get_connected_components(N, rows, cols)
+
+class _PoolStatistics:
+    """The statistics of the samples of one iteration, calculated in parallel in a process pool."""
+
+    def __init__(self, data, pool=None):
+        self.data = data
+        self.pool = pool
+
+    def variances(self):
+        """Calculates the empirical variance of every arm.
+
+        Returns:
+            List of variances for every arm.
+        """
+        return _calculate_variances(self.data, self.pool)
+
+    def distances(self, candidates=None):
+        """Calculates the empirical distances of pairs of arms.
+
+        Args:
+            candidates (optional): Boolean numpy array marking the pairs to calculate the distance for. Defaults to
+            all pairs.
+
+        Returns:
+            Numpy array containing the empirical distances of all pairs of arms in a matrix. Pairs that were not
+            calculated are zero.
+        """
+        pairs = None if candidates is None else [tuple(pair) for pair in np.argwhere(candidates).tolist()]
+        return _calculate_distances(self.data, pairs, self.pool)
+
+    def statistics(self):
+        """Calculates the variances and distances of all arms together.
+
+        Returns:
+            List of variances for every arm, numpy array containing the empirical distances of all pairs of arms in a
+            matrix.
+        """
+        return _calculate_variances_and_distances(self.data, self.pool)
+
+    def gram(self, i, j):
+        """Calculates the Gram matrix of the samples of arm i and the samples of arm j.
+
+        Args:
+            i (int): Number of the first arm.
+            j (int): Number of the second arm.
+
+        Returns:
+            Numpy array with the kernel value of sample t of arm i and sample s of arm j at position t, s.
+        """
+        return _gram(self.data[i], self.data[j])
+
+def _VKABC_CLUSTER(k, delta, arms, landmarks=0, permutations=0, data=None, pool=None, source=None):
+    """The clustering procedure used in the adaptive VKABC algorithm
+
+    Args:
+        k: Iteration.
+        delta: Confidence setting.
+        arms: Multi-armed bandit.
+        landmarks (int, optional): Number of landmarks of the pre-filter. Pairs whose lower bound on the distance
+        already exceeds the bound are pruned without calculating the exact distance, except for the few that the
+        estimate of the theoretical sampling complexity needs. Defaults to 0, which disables the pre-filter.
+        permutations (int, optional): Number of permutations per pair to calibrate the bounds with. Iterations whose
+        level can not be reached use the analytic bounds. Defaults to 0, which uses the analytic bounds.
+        data (list, optional): Samples already drawn for this iteration. Defaults to None, which draws them.
+        pool (optional): Process pool to use. Defaults to None, which uses a new one for every calculation.
+        source (optional): Statistics of the samples of this iteration, like _PoolStatistics or a prefix of
+        _SharedSamples. Defaults to None, which calculates them from data in pool.
+
+    Returns:
+        List of lists as the clustering, the number of samples drawn, the estimate of the theoretical sampling
+        complexity.
+    """
+    N = len(arms)
+    # First, we need to calculate the sample size
+    nk = _vkabc_sample_size(k, delta, N)
+    if source is None:
+        source = _PoolStatistics(_sample(nk, arms) if data is None else data, pool)
 
-            d = dists[i][j]
-            print(f"comparing arm {i} and {j}: {d} <= {bound}")
-            if dists[i][j] <= bound:
-                incidence[i][j] = 1
-                incidence[j][i] = 1
+    # print(f"sampling {nk} values")
 
-    return _get_connected_components(incidence), N * nk, tau
+    candidates = None
+    if landmarks:
+        varis = source.variances()
+        bounds = _vkabc_bounds(k, delta, nk, varis)
+        lower_bounds = _calculate_distance_lower_bounds(source.data, landmarks)
+        dists, candidates = _prefiltered_distances(arms, bounds, lower_bounds, source.distances)
+    else:
+        statistics = None
+        if permutations:
+            statistics = _permutation_statistics(k, delta, N, nk, source.gram, permutations)
+        if statistics is None:
+            varis, dists = source.statistics()
+            bounds = _vkabc_bounds(k, delta, nk, varis)
+        else:
+            varis, dists, bounds = statistics
+    tau = _calculate_tau(arms, delta, varis, dists)
+
+    print(f"VKABC sampled {nk} times per arm")
+    return _cluster(dists, bounds, candidates), N * nk, tau
 
-def _KABC_CLUSTER(k, delta, arms):
+def _KABC_CLUSTER(k, delta, arms, landmarks=0, permutations=0, data=None, pool=None, source=None):
     """The clustering procedure used in the adaptive KABC algorithm
 
     Args:
         k: Iteration.
         delta: Confidence setting.
         arms: Multi-armed bandit.
+        landmarks (int, optional): Number of landmarks of the pre-filter. Pairs whose lower bound on the distance
+        already exceeds the bound are pruned without calculating the exact distance. Defaults to 0, which disables
+        the pre-filter.
+        permutations (int, optional): Number of permutations per pair to calibrate the bounds with. Iterations whose
+        level can not be reached use the analytic bounds. Defaults to 0, which uses the analytic bounds.
+        data (list, optional): Samples already drawn for this iteration. Defaults to None, which draws them.
+        pool (optional): Process pool to use. Defaults to None, which uses a new one for every calculation.
+        source (optional): Statistics of the samples of this iteration, like _PoolStatistics or a prefix of
+        _SharedSamples. Defaults to None, which calculates them from data in pool.
 
     Returns:
         List of lists as the clustering, the number of samples drawn, -1
     """
     N = len(arms)
     # First, we need to calculate the sample size
-    log_term = 2 * math.log(k) + math.log((8 * (N*N - N))/delta)
-    nk = math.ceil(2**k * log_term)
-    delta_k = delta / (4 * (k * k))
-    data = _sample(nk, arms)
-    dists = _calculate_distances(data)
-    incidence = np.zeros((N, N))
+    nk = _kabc_sample_size(k, delta, N)
+    if source is None:
+        source = _PoolStatistics(_sample(nk, arms) if data is None else data, pool)
 
-    g_bar = 1
+    candidates = None
+    if landmarks:
+        bounds = _kabc_bounds(k, delta, N, nk)
+        lower_bounds = _calculate_distance_lower_bounds(source.data, landmarks)
+        dists, candidates = _prefiltered_distances(arms, bounds, lower_bounds, source.distances, tau=False)
+    else:
+        statistics = None
+        if permutations:
+            statistics = _permutation_statistics(k, delta, N, nk, source.gram, permutations)
+        if statistics is None:
+            dists = source.distances()
+            bounds = _kabc_bounds(k, delta, N, nk)
+        else:
+            _, dists, bounds = statistics
 
-    bound = (2 * math.sqrt(g_bar/nk)) + (2 * math.sqrt((2 * g_bar * math.log((2 * (N*N - N))/delta_k))/nk))
+    print(f"KABC sampled {nk} times per arm")
+    return _cluster(dists, bounds, candidates), N * nk, -1
 
-    print(f"sampled {nk} times per arm")
-    for i in range(N):
-        for j in range(i):
-            d = dists[i][j]
-            print(f"comparing arm {i} and {j}: {d} <= {bound}")
-            if d <= bound:
-                incidence[i][j] = 1
-                incidence[j][i] = 1
+def _keep_longest(sums, n):
+    """Removes all cached prefix sums except the ones of the longest prefix and of the prefix of length n.
+
+    Args:
+        sums (dict): The cached sums by the length of their prefix.
+        n (int): Length of the prefix that was just requested.
+    """
+    longest = max(sums)
+    for length in [length for length in sums if length not in (longest, n)]:
+        del sums[length]
+
+class _SharedSamples:
+    """A growing pool of samples for every arm together with a cache of kernel block sums.
+
+    Several algorithms can read prefixes of the same pools. The block sums of all pairs of arms are extended together
+    from the longest cached prefix, so only the kernel values involving new samples are ever calculated.
+    """
+
+    def __init__(self, arms, pipelined=False):
+        self.arms = arms
+        self.data = [None] * len(arms)
+        self.samples_drawn = 0
+        self.block_sums = {}
+        self.grams = {}
+        self.pair_sums = {}
+        self.sampler = _SpeculativeSampler(arms) if pipelined else None
+
+    def _size(self):
+        """Returns the number of samples in the pool of every arm."""
+        return 0 if self.data[0] is None else len(self.data[0])
+
+    def _append(self, data):
+        """Appends samples to the pools.
+
+        Args:
+            data: List with the new samples for every arm as a numpy array each.
+        """
+        for i, s in enumerate(data):
+            self.data[i] = s if self.data[i] is None else np.concatenate((self.data[i], s))
+            self.samples_drawn += len(s)
+
+    def prefetch(self, n):
+        """Starts growing the pools to n samples in the background if the pools are pipelined.
+
+        Args:
+            n (int): Number of samples every pool will have to hold.
+        """
+        if self.sampler is not None and self.sampler.future is None and self._size() < n:
+            self.sampler.start(n - self._size())
+
+    def close(self):
+        """Stops and discards a running background draw."""
+        if self.sampler is not None:
+            self.sampler.close()
+
+    def grow(self, n):
+        """Draws samples so that the pool of every arm holds at least n samples. Samples drawn in the background are
+        used first.
+
+        Args:
+            n (int): Number of samples every pool has to hold.
+        """
+        if self._size() < n and self.sampler is not None and self.sampler.future is not None:
+            self._append(self.sampler.result())
+        if self._size() < n:
+            self._append(_sample(n - self._size(), self.arms))
+
+    def _block_sums(self, n, elements=2**24):
+        """Calculates the sums of the kernel over the first n samples of arm i and the first n samples of arm j for
+        all pairs of arms.
+
+        Args:
+            n (int): Length of the prefixes.
+            elements (int, optional): Maximal number of kernel values held in memory at once. Defaults to 2**24.
+
+        Returns:
+            Numpy array containing the block sums of all pairs of arms in a matrix.
+        """
+        if n not in self.block_sums:
+            m = max((length for length in self.block_sums if length < n), default=0)
+            N = len(self.arms)
+            prefixes = np.stack([arm_data[:n] for arm_data in self.data])
+            pooled = prefixes.reshape(N * n, -1)
+            new_rows = np.zeros((N, N))
+            new_rows_old_columns = np.zeros((N, N))
+            chunk = max(1, elements // (N * N * n))
+            for c in range(m, n, chunk):
+                rows = prefixes[:, c:c + chunk].reshape(-1, pooled.shape[1])
+                g = _gram(rows, pooled).reshape(N, -1, N, n)
+                new_rows += np.sum(g, axis=(1, 3))
+                new_rows_old_columns += np.sum(g[..., :m], axis=(1, 3))
+            # The new columns of the old rows of arm i are the new rows of arm j against the old samples of arm i
+            self.block_sums[n] = self.block_sums.get(m, 0) + new_rows + new_rows_old_columns.T
+            _keep_longest(self.block_sums, n)
+        return self.block_sums[n]
+
+    def _pair_sum(self, i, j, n):
+        """Calculates the sum of the kernel over the first n samples of arm i and the first n samples of arm j.
+
+        The sum is extended from the longest cached prefix of the pair, which is independent of the block sums of all
+        pairs, so only the pairs that are needed are ever calculated.
+
+        Args:
+            i (int): Number of the first arm.
+            j (int): Number of the second arm.
+            n (int): Length of the prefixes.
 
-    return _get_connected_components(incidence), N * nk, -1
+        Returns:
+            number: The sum.
+        """
+        sums = self.pair_sums.setdefault((i, j), {})
+        if n not in sums:
+            m = max((length for length in sums if length < n), default=0)
+            x, y = self.data[i], self.data[j]
+            sums[n] = sums.get(m, 0.0) + _gram_sum(x[m:n], y[:n]) + _gram_sum(x[:m], y[m:n])
+            _keep_longest(sums, n)
+        return sums[n]
 
+    def gram(self, i, j, n):
+        """Calculates the Gram matrix of the first n samples of arm i and the first n samples of arm j.
+
+        The Gram matrix of the longest prefix is cached for every pair and only extended by the kernel values
+        involving new samples.
+
+        Args:
+            i (int): Number of the first arm.
+            j (int): Number of the second arm.
+            n (int): Length of the prefixes, at most the number of samples in the pools.
+
+        Returns:
+            Numpy array with the kernel value of sample t of arm i and sample s of arm j at position t, s.
+        """
+        cached = self.grams.get((i, j))
+        m = 0 if cached is None else len(cached)
+        if m < n:
+            x, y = self.data[i][:n], self.data[j][:n]
+            extended = np.empty((n, n))
+            if m:
+                extended[:m, :m] = cached
+                extended[:m, m:] = _gram(x[:m], y[m:])
+            extended[m:, :] = _gram(x[m:], y)
+            self.grams[(i, j)] = cached = extended
+        return cached[:n, :n]
+
+    def prefix(self, n):
+        """Returns the statistics of the first n samples of every pool, calculated through the caches.
+
+        Args:
+            n (int): Number of samples per arm, at most the number of samples in the pools.
+
+        Returns:
+            _SharedPrefix: The statistics.
+        """
+        return _SharedPrefix(self, n)
+
+    def release_grams(self):
+        """Frees the cached Gram matrices. The level of the permutation tests only gets stricter in later iterations,
+        so they are not needed any more once it can not be reached.
+        """
+        self.grams.clear()
+
+    def statistics(self, n, candidates=None):
+        """Calculates the variances and distances of all arms from the first n samples of every pool.
+
+        Args:
+            n (int): Number of samples per arm, at most the number of samples in the pools.
+            candidates (optional): Boolean numpy array marking the pairs to calculate the distance for. Defaults to
+            all pairs, which are calculated together from the block sums.
+
+        Returns:
+            List of variances for every arm, numpy array containing the empirical distances of all pairs of arms in a
+            matrix. Pairs that were not calculated are zero.
+        """
+        if candidates is None:
+            sums = self._block_sums(n)
+        else:
+            N = len(self.arms)
+            sums = np.zeros((N, N))
+            for i in range(N):
+                sums[i][i] = self._pair_sum(i, i, n)
+            for i, j in np.argwhere(candidates).tolist():
+                sums[i][j] = sums[j][i] = self._pair_sum(max(i, j), min(i, j), n)
+        # The kernel of a sample with itself is 1
+        self_sums = np.diag(sums)
+        variances = list((n - self_sums / n) / (n - 1))
+        d_squared = (self_sums[:, None] - 2 * sums + self_sums[None, :]) / (n * n)
+        distances = np.sqrt(np.maximum(d_squared, 0))
+        np.fill_diagonal(distances, 0)
+        if candidates is not None:
+            distances[~(candidates | candidates.T)] = 0
+        return variances, distances
+
+
+class _SharedPrefix:
+    """The statistics of the first n samples of every pool of _SharedSamples, with the interface of _PoolStatistics."""
+
+    def __init__(self, shared, n):
+        self.shared = shared
+        self.n = n
+        self.data = [arm_data[:n] for arm_data in shared.data]
+
+    def variances(self):
+        """Calculates the empirical variance of every arm from the sums of the arms with themselves."""
+        N = len(self.data)
+        return self.shared.statistics(self.n, np.zeros((N, N), dtype=bool))[0]
+
+    def distances(self, candidates=None):
+        """Calculates the empirical distances of the pairs of arms marked in candidates, or of all pairs if None."""
+        return self.shared.statistics(self.n, candidates)[1]
+
+    def statistics(self):
+        """Calculates the variances and distances of all arms together from the block sums."""
+        return self.shared.statistics(self.n)
+
+    def gram(self, i, j):
+        """Returns the cached Gram matrix of arm i and arm j."""
+        return self.shared.gram(i, j, self.n)
+
+
+class _SpeculativeSampler:
+    """Draws samples of every arm in a background thread while the caller computes.
+
+    A draw is stopped between two arms when the sampler is closed, so a speculative draw that is not needed any more
+    does not outlive the run.
+    """
+
+    def __init__(self, arms):
+        self.arms = arms
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.stop = threading.Event()
+        self.future = None
+        self.sampling_time = 0.0
+        self.waiting_time = 0.0
+
+    def _sample(self, n):
+        """Samples every arm n times unless the sampler is closed in between.
+
+        Args:
+            n (int): Number of times every arm is sampled.
+
+        Returns:
+            List with the samples for every arm as a numpy array each or None if stopped, the duration in seconds.
+        """
+        start = time.perf_counter()
+        data = []
+        for arm in self.arms:
+            if self.stop.is_set():
+                return None, 0.0
+            data.append(arm.sample(n))
+        return data, time.perf_counter() - start
+
+    def start(self, n):
+        """Starts sampling every arm n times in the background.
+
+        Args:
+            n (int): Number of times every arm is sampled.
+        """
+        self.future = self.executor.submit(self._sample, n)
+
+    def result(self):
+        """Waits for the started draw.
+
+        Returns:
+            List with the samples for every arm as a numpy array each.
+        """
+        start = time.perf_counter()
+        data, duration = self.future.result()
+        self.future = None
+        self.waiting_time += time.perf_counter() - start
+        self.sampling_time += duration
+        return data
+
+    def close(self):
+        """Stops and discards a running draw, waits for the thread and prints the achieved overlap."""
+        self.stop.set()
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        overlap = max(self.sampling_time - self.waiting_time, 0)
+        print(f"overlapped {overlap:.3f}s of {self.sampling_time:.3f}s of sampling with computation")
 
 def _adaptive(delta, K, arms, CLUSTER):
     """The adaptive algorithm.
@@ -338,8 +1068,125 @@ def _adaptive(delta, K, arms, CLUSTER):
             return clusters, sampling_complexity, tau
         k += 1
 
-def VKABC(delta, K, arms):
-    return _adaptive(delta, K, arms, _VKABC_CLUSTER)
+def _pipelined_adaptive(delta, K, arms, CLUSTER, SAMPLE_SIZE):
+    """The adaptive algorithm, drawing the samples of the next iteration in a background thread while the current
+    iteration is computed.
+
+    If an iteration reaches K clusters, the draw for the next one is stopped and its samples are discarded. The time
+    the sampling overlapped with the computation is printed at the end.
+
+    Args:
+        delta: Confidence setting.
+        K: Total number of clusters.
+        arms: Multi-armed bandit.
+        CLUSTER: The clustering procedure to use.
+        SAMPLE_SIZE: The number of samples per arm of the clustering procedure in an iteration.
+
+    Returns:
+        The result from the CLUSTER algorithm as soon as K clusters are reached.
+    """
+    N = len(arms)
+    k = 2
+    sampling_complexity = 0
+    # The processes are forked once before the sampling thread starts, never while it runs
+    with Pool(processes=processes) as pool:
+        sampler = _SpeculativeSampler(arms)
+        try:
+            sampler.start(SAMPLE_SIZE(k, delta, N))
+            while True:
+                data = sampler.result()
+                sampler.start(SAMPLE_SIZE(k + 1, delta, N))
+                clusters, samples_drawn, tau = CLUSTER(k, delta, arms, data=data, pool=pool)
+                sampling_complexity += samples_drawn
+                if len(clusters) >= K:
+                    return clusters, sampling_complexity, tau
+                k += 1
+        finally:
+            sampler.close()
+
+def VKABC(delta, K, arms, landmarks=0, permutations=0, pipelined=False):
+    if landmarks and permutations:
+        raise ValueError("The pre-filter can only be used with the analytic bounds")
+    CLUSTER = partial(_VKABC_CLUSTER, landmarks=landmarks, permutations=permutations)
+    if pipelined:
+        return _pipelined_adaptive(delta, K, arms, CLUSTER, _vkabc_sample_size)
+    return _adaptive(delta, K, arms, CLUSTER)
+
+def KABC(delta, K, arms, landmarks=0, permutations=0, pipelined=False):
+    if landmarks and permutations:
+        raise ValueError("The pre-filter can only be used with the analytic bounds")
+    CLUSTER = partial(_KABC_CLUSTER, landmarks=landmarks, permutations=permutations)
+    if pipelined:
+        return _pipelined_adaptive(delta, K, arms, CLUSTER, _kabc_sample_size)
+    return _adaptive(delta, K, arms, CLUSTER)
+
+def VKABC_KABC(delta, K, arms, landmarks=0, permutations=0, pipelined=False):
+    """Runs VKABC and KABC side by side on one shared pool of samples per arm.
+
+    In every iteration each algorithm reads the prefix of the pools it needs, and the kernel block sums, or the Gram
+    matrices with permutation-calibrated bounds, are shared through a common cache. The sampling complexities are
+    counted as if every algorithm drew fresh samples, so they are comparable to the ones of VKABC and KABC.
+
+    Args:
+        delta: Confidence setting.
+        K: Total number of clusters.
+        arms: Multi-armed bandit.
+        landmarks (int, optional): Number of landmarks of the pre-filter of both algorithms. Only the kernel sums of
+        the pairs that are not pruned are calculated. Defaults to 0, which disables the pre-filter.
+        permutations (int, optional): Number of permutations per pair to calibrate the bounds with. Iterations whose
+        level can not be reached use the analytic bounds. Defaults to 0, which uses the analytic bounds.
+        pipelined (bool, optional): Whether the pools are grown for the next iteration in a background thread while
+        the current iteration is computed. Defaults to False.
+
+    Returns:
+        The results of VKABC and KABC.
+    """
+    if landmarks and permutations:
+        raise ValueError("The pre-filter can only be used with the analytic bounds")
+    shared = _SharedSamples(arms, pipelined)
+    try:
+        return _joint_adaptive(delta, K, arms, shared, landmarks, permutations)
+    finally:
+        shared.close()
+
+def _joint_adaptive(delta, K, arms, shared, landmarks, permutations):
+    """The adaptive algorithm running VKABC and KABC side by side on shared pools of samples.
 
-def KABC(delta, K, arms):
-    return _adaptive(delta, K, arms, _KABC_CLUSTER)
\ No newline at end of file
+    Args:
+        delta: Confidence setting.
+        K: Total number of clusters.
+        arms: Multi-armed bandit.
+        shared (_SharedSamples): The shared pools of samples.
+        landmarks (int): Number of landmarks of the pre-filter, 0 to disable it.
+        permutations (int): Number of permutations per pair, 0 for the analytic bounds.
+
+    Returns:
+        The results of VKABC and KABC.
+    """
+    N = len(arms)
+    result_vkabc = None
+    result_kabc = None
+    sampling_complexity_vkabc = 0
+    sampling_complexity_kabc = 0
+    k = 2
+    while result_vkabc is None or result_kabc is None:
+        SAMPLE_SIZE = _vkabc_sample_size if result_vkabc is None else _kabc_sample_size
+        shared.grow(SAMPLE_SIZE(k, delta, N))
+        shared.prefetch(SAMPLE_SIZE(k + 1, delta, N))
+        if permutations and _permutation_rank(k, delta, N, permutations) is None:
+            shared.release_grams()
+        if result_kabc is None:
+            clusters, samples_drawn, _ = _KABC_CLUSTER(
+                k, delta, arms, landmarks, permutations, source=shared.prefix(_kabc_sample_size(k, delta, N)))
+            sampling_complexity_kabc += samples_drawn
+            if len(clusters) >= K:
+                result_kabc = clusters, sampling_complexity_kabc, -1
+        if result_vkabc is None:
+            clusters, samples_drawn, tau = _VKABC_CLUSTER(
+                k, delta, arms, landmarks, permutations, source=shared.prefix(_vkabc_sample_size(k, delta, N)))
+            sampling_complexity_vkabc += samples_drawn
+            if len(clusters) >= K:
+                result_vkabc = clusters, sampling_complexity_vkabc, tau
+        k += 1
+    print(f"drew {shared.samples_drawn} samples for both algorithms")
+    return result_vkabc, result_kabc
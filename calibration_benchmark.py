@@ -0,0 +1,78 @@
+import pickle
+from algorithms.vkabc import VKABC_KABC, calibrated_iterations, final_iteration
+from same_mean_experiment import get_same_mean_experiment
+from multimodal_experiment import get_multimodal_experiment
+
+DELTA = 0.5
+
+# Reaches the level of every pair in the iterations k = 2, 3, 4 of the four-arm experiments. Runs that need more
+# iterations finish with the analytic bounds, which is recorded with their results.
+PERMUTATIONS = 2000
+
+def is_correct(clusters, arms):
+    """Checks whether a clustering matches the true clusters of the arms.
+
+    Args:
+        clusters (list): Clustering as a list of lists of arm numbers.
+        arms (list[Arm]): The multi-armed bandit as a list of arms.
+
+    Returns:
+        bool: Whether the clustering is correct.
+    """
+    true_clusters = {}
+    for i, arm in enumerate(arms):
+        true_clusters.setdefault(arm.get_cluster(), set()).add(i)
+    return sorted(map(sorted, clusters)) == sorted(map(sorted, true_clusters.values()))
+
+def benchmark(arms, K):
+    """Runs VKABC and KABC with the analytic and the permutation-calibrated bounds on a model.
+
+    Args:
+        arms (list[Arm]): The multi-armed bandit as a list of arms.
+        K (int): Number of clusters.
+
+    Returns:
+        dict: The sampling complexity, the correctness of the clustering and whether the run stopped in an iteration
+        with permutation-calibrated bounds for every algorithm and bound.
+    """
+    results = {}
+    last_calibrated = calibrated_iterations(DELTA, len(arms), PERMUTATIONS)
+    for bound, permutations in [('analytic', 0), ('permutation', PERMUTATIONS)]:
+        result_vkabc, result_kabc = VKABC_KABC(DELTA, K, arms, permutations=permutations)
+        for algorithm, (clusters, sampling_complexity, _) in [('VKABC', result_vkabc), ('KABC', result_kabc)]:
+            calibrated = (bool(permutations)
+                          and final_iteration(algorithm, DELTA, len(arms), sampling_complexity) <= last_calibrated)
+            results[(algorithm, bound)] = (sampling_complexity, is_correct(clusters, arms), calibrated)
+    return results
+
+def execute():
+    """Compares the samples needed for a correct clustering with the analytic and the permutation-calibrated bounds on
+    the same mean and the multimodal experiment.
+    """
+
+    same_mean = {}
+    for V in [200, 400, 800, 1600, 3200, 6400]:
+        arms, K = get_same_mean_experiment(V)
+        same_mean[V] = benchmark(arms, K)
+
+    multimodal = {}
+    for t in range(10):
+        frac = float(t) * 0.1
+        arms, _, _, K = get_multimodal_experiment(frac)
+        multimodal[frac] = benchmark(arms, K)
+
+    for name, results in [('same mean', same_mean), ('multimodal', multimodal)]:
+        print("----------------------------")
+        print(f"{name} experiment: samples (correct, stopped in a calibrated iteration)")
+        for parameter, result in results.items():
+            row = ", ".join(f"{algorithm} {bound}: {samples} ({correct}, {calibrated})"
+                            for (algorithm, bound), (samples, correct, calibrated) in result.items())
+            print(f"{parameter}: {row}")
+
+    with open('data/calibration_benchmark_same_mean.p', 'wb') as fp:
+        pickle.dump(same_mean, fp, protocol=pickle.HIGHEST_PROTOCOL)
+    with open('data/calibration_benchmark_multimodal.p', 'wb') as fp:
+        pickle.dump(multimodal, fp, protocol=pickle.HIGHEST_PROTOCOL)
+
+if __name__ == '__main__':
+    execute()
@@ -2,7 +2,7 @@ import numpy as np
 rng = np.random.default_rng()
 import pickle
 from model.arm import Arm, MultimodalArm
-from algorithms.vkabc import VKABC, KABC
+from algorithms.vkabc import VKABC_KABC
 from drawing.bandit_drawer import draw
 
 D = 50
@@ -60,8 +60,7 @@ def execute():
         print("----------------------------")
         print(f"Trying it with ratio on the other size: {frac}")
         
-        result, sampling_complexity, tau = VKABC(0.5, K, arms)
-        result2, sampling_complexity2, _ = KABC(0.5, K, arms)
+        (result, sampling_complexity, tau), (result2, sampling_complexity2, _) = VKABC_KABC(0.5, K, arms)
         print(f"{result}, {sampling_complexity}, {tau}")
         print(f"{result2}, {sampling_complexity2}")
         sampling_complexities_VKABC[frac] = sampling_complexity
@@ -2,7 +2,7 @@ import numpy as np
 rng = np.random.default_rng()
 import pickle
 from model.arm import Arm
-from algorithms.vkabc import VKABC, KABC
+from algorithms.vkabc import VKABC_KABC
 
 def get_same_mean_experiment(V):
     """Generates a model with two distributions/clusters and two arms per cluster. The two clusters have the same mean 
@@ -48,8 +48,7 @@ def execute():
         print("----------------------------")
         print(f"Trying it with covariance of: {V} * id")
 
-        result, sampling_complexity, tau = VKABC(0.5, K, arms)
-        result2, sampling_complexity2, _ = KABC(0.5, K, arms)
+        (result, sampling_complexity, tau), (result2, sampling_complexity2, _) = VKABC_KABC(0.5, K, arms)
         print(f"{result}, {sampling_complexity}, {tau}")
         print(f"{result2}, {sampling_complexity2}")
         sampling_complexities_VKABC[V] = sampling_complexity